@@ -1,26 +1,34 @@
-import glob
+import argparse
+import concurrent.futures
+import getpass
 import json
 import os
 import shutil
 import sys
+import time
+import traceback
 from datetime import datetime
-from enum import Enum
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 from PyQt6 import QtWidgets, QtGui
+from PyQt6.QtCore import QTimer
 from PyQt6.QtWidgets import QApplication, QDialog, QPushButton, QVBoxLayout, QDialogButtonBox, QLabel, QInputDialog, \
-    QHBoxLayout, QListWidget, QFileDialog, QMessageBox
+    QHBoxLayout, QListWidget, QFileDialog, QMessageBox, QProgressBar, QCheckBox
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas, \
     NavigationToolbar2QT as NavigationToolbar
 
-import matplotlib.pyplot as plt
 from matplotlib import patches
+from matplotlib.figure import Figure
 from matplotlib.widgets import RectangleSelector
 
-from process_tif_map import crop_tif_map
+from annotation_server import AnnotationClient, AnnotationServerError
+from annotation_statistics import AnnotationStatistics
+from bounding_boxes import BoxesType, BoxIssue, find_box_issues, fix_box_issues, remove_overlapping_boxes
+from display import DisplayCrops
+from process_tif_map import crop_probe_directory
+from proposals import ProposalGenerator, PROPOSAL_IOU_THRESHOLD
 
 POLLEN_CLASSES = [
     'Alnus',
@@ -68,11 +76,6 @@ POLLEN_CLASSES = [
 ]
 
 
-class BoxesType(Enum):
-    MANUAL = 'manual_boxes'
-    EXISTING = 'existing_boxes'
-
-
 class CloseDialog(QMessageBox):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -82,18 +85,67 @@ class CloseDialog(QMessageBox):
         self.setStandardButtons(QMessageBox.StandardButton.Ok)
 
 
+class BoxFindingsDialog(QDialog):
+    def __init__(self, findings, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Bounding Box Check')
+        self.setMinimumWidth(800)
+
+        q_btn = QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel
+
+        self.buttonBox = QDialogButtonBox(q_btn)
+        self.buttonBox.button(QDialogButtonBox.StandardButton.Ok).setText('Fix Boxes')
+        self.buttonBox.button(QDialogButtonBox.StandardButton.Cancel).setText('Ignore')
+        self.buttonBox.accepted.connect(self.accept)
+        self.buttonBox.rejected.connect(self.reject)
+
+        findings_view = QListWidget()
+        findings_view.addItems([str(finding) for finding in findings])
+        self.remove_relabeled_checkbox = QCheckBox('Also remove detections that were relabeled by a new box')
+        self.remove_relabeled_checkbox.setVisible(any(finding.issue == BoxIssue.RELABELED for finding in findings))
+
+        self.layout = QVBoxLayout()
+        self.layout.addWidget(QLabel(f'Found {len(findings)} problematic bounding boxes:'))
+        self.layout.addWidget(findings_view)
+        self.layout.addWidget(self.remove_relabeled_checkbox)
+        self.layout.addWidget(self.buttonBox)
+        self.setLayout(self.layout)
+
+
 class Window(QtWidgets.QWidget):
     SAVED_STATE_FILE_NAME = 'saved_state.json'
     BACKUP_DIRECTORY = 'backups'
     BACKUP_INTERVAL = 100
-
-    def __init__(self, parent=None):
+    PROPOSAL_LOOKAHEAD = 10
+    PROPOSAL_POLL_INTERVAL = 250
+    STARTUP_POLL_INTERVAL = 50
+    STARTUP_TARGET_SECONDS = 1.0
+    PALETTE_KEYS = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '0']
+    KEYMAP = {
+        'A': 'activate_selector',
+        'Q': 'deactivate_selector',
+        'P': 'accept_proposed_bounding_box',
+        'F': 'toggle_fast_mode',
+        'C': 'choose_current_class',
+        'R': 'relabel_highlighted_bounding_box',
+        'D': 'delete_highlighted_bounding_box',
+        'Del': 'delete_highlighted_bounding_box',
+        'Ctrl+Z': 'undo',
+    }
+
+    def __init__(self, parent=None, server_url=None, annotator=None, startup_time=None):
         super(Window, self).__init__(parent)
 
+        self.startup_time = startup_time if startup_time is not None else time.perf_counter()
+
+        self.client = AnnotationClient(server_url, annotator) if server_url is not None else None
+
         self.backup_counter = 0
 
         self.current_probe_directory = None
         self.current_crops = None
+        self.current_display_crops = None
+        self.display_limits = {}
         self.current_crop_names = None
         self.current_existing_bounding_boxes = None
 
@@ -103,25 +155,48 @@ class Window(QtWidgets.QWidget):
         self.current_crop_name = None
         self.current_crop_existing_boxes = None
         self.current_crop_new_boxes = None
+        self.current_crop_proposed_boxes = None
 
         self.internal_boxes = {}
+        self.statistics = AnnotationStatistics()
 
-        self.processing_directory = QFileDialog.getExistingDirectory(self)
-        self.probe_directories = next(os.walk(self.processing_directory))[1]
-        try:
-            self.probe_directories.remove(self.BACKUP_DIRECTORY)
-        except ValueError:
-            print('No backup directory present.')
-        self.probe_directories = sorted(self.probe_directories)
-        self.load_state()
+        self.fast_mode = False
+        self.recent_classes = list(POLLEN_CLASSES)
+        self.highlighted_box = None
+        self.undo_stack = []
+        self.rectangle_selector = None
 
-        self.figure = plt.figure()
+        self.proposal_generator = ProposalGenerator()
+
+        self.directory_selection_seconds = 0.0
+        if self.client is not None:
+            self.processing_directory = server_url
+            self.probe_directories = self.client.get_probe_directories()
+        else:
+            directory_selection_start = time.perf_counter()
+            self.processing_directory = QFileDialog.getExistingDirectory(self)
+            self.directory_selection_seconds = time.perf_counter() - directory_selection_start
+            self.probe_directories = next(os.walk(self.processing_directory))[1]
+            try:
+                self.probe_directories.remove(self.BACKUP_DIRECTORY)
+            except ValueError:
+                print('No backup directory present.')
+            self.probe_directories = sorted(self.probe_directories)
+
+        self.figure = Figure()
 
         self.canvas = FigureCanvas(self.figure)
 
         self.ax = None
         self.header = QLabel('')
 
+        self.startup_finished = False
+        self.startup_stage = 'Starting...'
+        self.startup_label = QLabel(self.startup_stage)
+        self.startup_progress = QProgressBar()
+        self.startup_progress.setRange(0, 0)
+        self.startup_progress.setMaximumWidth(200)
+
         NavigationToolbar.toolitems = [
             ('Home', 'Reset original view', 'home', 'home'),
             ('Back', 'Back to previous view', 'back', 'back'),
@@ -135,6 +210,10 @@ class Window(QtWidgets.QWidget):
         self.export_button.setMaximumWidth(100)
         self.export_button.clicked.connect(self.export_csv)
 
+        self.check_button = QPushButton('Check Boxes')
+        self.check_button.setMaximumWidth(100)
+        self.check_button.clicked.connect(lambda: self.check_bounding_boxes(include_relabeled=True))
+
         self.skip_button = QPushButton('Skip Image')
         self.skip_button.clicked.connect(self.skip_image)
 
@@ -161,10 +240,53 @@ class Window(QtWidgets.QWidget):
         self.existing_bounding_boxes_view.itemSelectionChanged.connect(self.select_current_existing_bounding_box)
         self.existing_bounding_boxes_view.itemDoubleClicked.connect(self.delete_existing_bounding_box)
 
+        self.proposed_bounding_boxes_view = QListWidget()
+        self.proposed_bounding_boxes_view.setMinimumWidth(200)
+        self.proposed_bounding_boxes_view.setMaximumWidth(200)
+        self.proposed_bounding_boxes_view.itemSelectionChanged.connect(self.select_current_proposed_bounding_box)
+        self.proposed_bounding_boxes_view.itemDoubleClicked.connect(self.accept_proposed_bounding_box)
+
+        self.fast_mode_button = QPushButton('Fast Mode (F)')
+        self.fast_mode_button.setCheckable(True)
+        self.fast_mode_button.toggled.connect(self.set_fast_mode)
+
+        self.class_palette = QLabel('')
+        self.class_palette.setMinimumWidth(200)
+        self.class_palette.setMaximumWidth(200)
+        self.set_class_palette()
+
+        self.progress_label = QLabel('')
+        self.progress_label.setWordWrap(True)
+        self.progress_label.setMinimumWidth(200)
+        self.progress_label.setMaximumWidth(200)
+
+        self.class_statistics_view = QListWidget()
+        self.class_statistics_view.setMinimumWidth(200)
+        self.class_statistics_view.setMaximumWidth(200)
+
+        self.shortcuts = []
+        for key, method_name in self.KEYMAP.items():
+            shortcut = QtGui.QShortcut(QtGui.QKeySequence(key), self)
+            shortcut.activated.connect(getattr(self, method_name))
+            self.shortcuts.append(shortcut)
+        for palette_index, key in enumerate(self.PALETTE_KEYS):
+            shortcut = QtGui.QShortcut(QtGui.QKeySequence(key), self)
+            shortcut.activated.connect(
+                lambda palette_index=palette_index: self.select_palette_class(palette_index)
+            )
+            self.shortcuts.append(shortcut)
+
+        self.proposal_timer = QTimer(self)
+        self.proposal_timer.timeout.connect(self.poll_proposals)
+        self.proposal_timer.start(self.PROPOSAL_POLL_INTERVAL)
+
         layout = QVBoxLayout()
 
         row0 = QHBoxLayout()
         row0.addWidget(self.header)
+        row0.addWidget(self.startup_label)
+        row0.addWidget(self.startup_progress)
+        row0.addWidget(self.check_button)
         row0.addWidget(self.export_button)
         layout.addLayout(row0)
 
@@ -173,6 +295,10 @@ class Window(QtWidgets.QWidget):
         folder_selection_layout = QVBoxLayout()
         folder_selection_layout.addWidget(QLabel('Folder selection:'))
         folder_selection_layout.addWidget(self.folder_selection_view)
+        folder_selection_layout.addWidget(self.class_palette)
+        folder_selection_layout.addWidget(QLabel('Progress:'))
+        folder_selection_layout.addWidget(self.progress_label)
+        folder_selection_layout.addWidget(self.class_statistics_view)
 
         row1.addLayout(folder_selection_layout)
         row1.addWidget(self.canvas)
@@ -181,11 +307,14 @@ class Window(QtWidgets.QWidget):
         boxes_list_layout.addWidget(self.new_bounding_boxes_view)
         boxes_list_layout.addWidget(QLabel('Existing bounding boxes:'))
         boxes_list_layout.addWidget(self.existing_bounding_boxes_view)
+        boxes_list_layout.addWidget(QLabel('Proposed bounding boxes (P to accept):'))
+        boxes_list_layout.addWidget(self.proposed_bounding_boxes_view)
         row1.addLayout(boxes_list_layout)
         layout.addLayout(row1)
 
         row2 = QHBoxLayout()
         row2.addWidget(self.toolbar)
+        row2.addWidget(self.fast_mode_button)
         row2.addWidget(self.previous_button)
         row2.addWidget(self.next_button)
         row2.addWidget(self.skip_button)
@@ -193,8 +322,57 @@ class Window(QtWidgets.QWidget):
 
         self.setLayout(layout)
 
+        # Loading the state and tiling the first folder run in the background so that the window shows immediately.
+        self.startup_widgets = [
+            self.canvas, self.toolbar, self.check_button, self.export_button, self.skip_button, self.next_button,
+            self.previous_button, self.fast_mode_button, self.folder_selection_view, self.new_bounding_boxes_view,
+            self.existing_bounding_boxes_view, self.proposed_bounding_boxes_view, *self.shortcuts,
+        ]
+        for widget in self.startup_widgets:
+            widget.setEnabled(False)
+        self.startup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.startup_future = self.startup_executor.submit(self.load_startup_data)
+        self.startup_timer = QTimer(self)
+        self.startup_timer.timeout.connect(self.finish_startup)
+        self.startup_timer.start(self.STARTUP_POLL_INTERVAL)
+
+    def load_startup_data(self):
+        self.startup_stage = 'Loading saved state...'
+        self.load_state()
+        self.startup_stage = f'Tiling {self.current_probe_directory}...'
+        self.process_probe_directory(self.current_probe_directory)
+
+    def finish_startup(self):
+        if not self.startup_future.done():
+            self.startup_label.setText(self.startup_stage)
+            return
+        self.startup_timer.stop()
+        self.startup_executor.shutdown(wait=False)
+        error = self.startup_future.exception()
+        if error is not None:
+            # The controls stay disabled, a half loaded state must not be annotated or saved.
+            traceback.print_exception(type(error), error, error.__traceback__)
+            self.startup_progress.hide()
+            self.startup_label.setText(f'Startup failed: {type(error).__name__}: {error}')
+            QMessageBox.critical(self, 'Startup Failed', f'{type(error).__name__}: {error}')
+            return
+        self.startup_label.hide()
+        self.startup_progress.hide()
+        for widget in self.startup_widgets:
+            widget.setEnabled(True)
         self.set_folder_list()
         self.set_initial_crop()
+        self.startup_finished = True
+        print(f'First image shown after {self.startup_seconds():.2f}s.')
+
+    def startup_seconds(self):
+        return time.perf_counter() - self.startup_time - self.directory_selection_seconds
+
+    def report_window_startup(self):
+        startup_seconds = self.startup_seconds()
+        print(f'Window shown after {startup_seconds:.2f}s (target {self.STARTUP_TARGET_SECONDS:.2f}s).')
+        if startup_seconds > self.STARTUP_TARGET_SECONDS:
+            print('Startup exceeded the target time.')
 
     def set_folder_list(self):
         self.folder_selection_view.addItems(self.probe_directories)
@@ -203,22 +381,20 @@ class Window(QtWidgets.QWidget):
         self._show_next_image(from_folder=item.text())
 
     def process_probe_directory(self, probe_directory):
-        tif_path_string = f'{self.processing_directory}/{probe_directory}/images/{probe_directory}_map.tif'
-        try:
-            tif_path = Path(glob.glob(tif_path_string)[0])
-
-            fast_syns = glob.glob(f'{self.processing_directory}/{probe_directory}/images/*FAST.SYN._FP.png')
-            firsts = [str(Path(s).name)[12:14] for s in fast_syns]
-            first_end = int(max(firsts))
-
-            self.current_crops, self.current_crop_names, self.current_existing_bounding_boxes = crop_tif_map(tif_path, first_end)
-        except IndexError:
-            self.current_crops = []
-            self.current_crop_names = []
-            self.current_existing_bounding_boxes = []
+        if self.client is not None:
+            self.current_crops, self.current_crop_names, self.current_existing_bounding_boxes, display_limits = \
+                self.client.get_probe(probe_directory)
+            self.current_display_crops = DisplayCrops(self.current_crops, display_limits)
+            return
+        self.current_crops, self.current_crop_names, self.current_existing_bounding_boxes = crop_probe_directory(
+            self.processing_directory,
+            probe_directory
+        )
+        # Limits are computed once per probe, switching back to a probe or re-processing it reuses them.
+        self.current_display_crops = DisplayCrops(self.current_crops, self.display_limits.get(probe_directory))
+        self.display_limits[probe_directory] = self.current_display_crops.limits
 
     def set_initial_crop(self):
-        self.process_probe_directory(self.current_probe_directory)
         try:
             self.current_crop = self.current_crops[self.current_crop_index]
             self.current_crop_name = self.current_crop_names[self.current_crop_index]
@@ -280,6 +456,11 @@ class Window(QtWidgets.QWidget):
             self.previous_button.setEnabled(False)
 
     def set_crop_bounding_boxes(self):
+        if self.client is not None:
+            # Other annotators may have changed this crop since the state was loaded.
+            boxes = self.client.get_annotations(self.build_crop_path())
+            if boxes is not None:
+                self.internal_boxes[self.build_crop_path()] = boxes
         try:
             crop_path = self.build_crop_path()
             self.current_crop_new_boxes = self.internal_boxes[crop_path][BoxesType.MANUAL.value]
@@ -290,39 +471,48 @@ class Window(QtWidgets.QWidget):
             self.current_crop_new_boxes = []
             self.current_crop_skip = False
 
-    def build_crop_path(self):
-        return f'{self.current_probe_directory}/images/{self.current_crop_name}'
+    def build_crop_path(self, crop_name=None):
+        if crop_name is None:
+            crop_name = self.current_crop_name
+        return f'{self.current_probe_directory}/images/{crop_name}'
 
     def select_current_bounding_box(self):
         index = self.new_bounding_boxes_view.currentRow()
+        self.highlighted_box = (BoxesType.MANUAL, index)
         self.annotate_image(highlighted_index=index, highlight_type=BoxesType.MANUAL)
 
     def select_current_existing_bounding_box(self):
         index = self.existing_bounding_boxes_view.currentRow()
+        self.highlighted_box = (BoxesType.EXISTING, index)
         self.annotate_image(highlighted_index=index, highlight_type=BoxesType.EXISTING)
 
-    def delete_bounding_box(self, item):
-        delete_dialog = QDialog()
-        delete_dialog.setWindowTitle('Delete Bounding Box')
-
-        q_btn = QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel
+    def select_current_proposed_bounding_box(self):
+        index = self.proposed_bounding_boxes_view.currentRow()
+        self.highlighted_box = (BoxesType.PROPOSED, index)
+        self.annotate_image(highlighted_index=index, highlight_type=BoxesType.PROPOSED)
 
-        delete_dialog.buttonBox = QDialogButtonBox(q_btn)
-        delete_dialog.buttonBox.accepted.connect(delete_dialog.accept)
-        delete_dialog.buttonBox.rejected.connect(delete_dialog.reject)
-
-        delete_dialog.layout = QVBoxLayout()
-        message = QLabel(f'Delete Bounding Box: {item.text()}')
-        delete_dialog.layout.addWidget(message)
-        delete_dialog.layout.addWidget(delete_dialog.buttonBox)
-        delete_dialog.setLayout(delete_dialog.layout)
-        if delete_dialog.exec():
-            index = self.new_bounding_boxes_view.currentRow()
-            self.new_bounding_boxes_view.takeItem(index)
-            del self.current_crop_new_boxes[index]
-            self.annotate_image()
+    def delete_bounding_box(self, item):
+        if self.confirm_deletion(item.text()):
+            self.delete_box(BoxesType.MANUAL, self.new_bounding_boxes_view.currentRow())
 
     def delete_existing_bounding_box(self, item):
+        if self.confirm_deletion(item.text()):
+            self.delete_box(BoxesType.EXISTING, self.existing_bounding_boxes_view.currentRow())
+
+    def delete_highlighted_bounding_box(self):
+        if self.fast_mode and self.is_box_highlighted():
+            self.delete_box(*self.highlighted_box)
+
+    def is_box_highlighted(self):
+        if self.highlighted_box is None:
+            return False
+        boxes_type, index = self.highlighted_box
+        crop_boxes, _ = self.get_crop_boxes(boxes_type)
+        return crop_boxes is not None and 0 <= index < len(crop_boxes)
+
+    def confirm_deletion(self, box_text):
+        if self.fast_mode:
+            return True
         delete_dialog = QDialog()
         delete_dialog.setWindowTitle('Delete Bounding Box')
 
@@ -333,32 +523,147 @@ class Window(QtWidgets.QWidget):
         delete_dialog.buttonBox.rejected.connect(delete_dialog.reject)
 
         delete_dialog.layout = QVBoxLayout()
-        message = QLabel(f'Delete Bounding Box: {item.text()}')
+        message = QLabel(f'Delete Bounding Box: {box_text}')
         delete_dialog.layout.addWidget(message)
         delete_dialog.layout.addWidget(delete_dialog.buttonBox)
         delete_dialog.setLayout(delete_dialog.layout)
-        if delete_dialog.exec():
-            index = self.existing_bounding_boxes_view.currentRow()
-            self.existing_bounding_boxes_view.takeItem(index)
-            del self.current_crop_existing_boxes[index]
-            self.annotate_image()
+        return bool(delete_dialog.exec())
+
+    def delete_box(self, boxes_type, index):
+        undo_entry = []
+        self.remove_box(boxes_type, index, undo_entry)
+        self.finish_box_change(undo_entry)
+
+    def relabel_highlighted_bounding_box(self):
+        if not self.fast_mode or not self.is_box_highlighted():
+            return
+        boxes_type, index = self.highlighted_box
+        undo_entry = []
+        bounding_box = self.remove_box(boxes_type, index, undo_entry)[0]
+        new_index = index if boxes_type == BoxesType.MANUAL else len(self.current_crop_new_boxes)
+        self.insert_box(BoxesType.MANUAL, new_index, [bounding_box, self.recent_classes[0]], undo_entry)
+        self.finish_box_change(undo_entry)
+
+    def accept_proposed_bounding_box(self):
+        if not self.current_crop_proposed_boxes:
+            return
+        index = max(self.proposed_bounding_boxes_view.currentRow(), 0)
+        selected, ok = self.select_pollen_class()
+        if ok:
+            undo_entry = []
+            bounding_box = self.remove_box(BoxesType.PROPOSED, index, undo_entry)[0]
+            self.add_manual_box(bounding_box, selected, undo_entry)
 
     def line_select_callback(self, click_event, release_event):
-        x1, y1 = int(click_event.xdata), int(click_event.ydata)
-        x2, y2 = int(release_event.xdata), int(release_event.ydata)
+        x1, x2 = sorted([int(click_event.xdata), int(release_event.xdata)])
+        y1, y2 = sorted([int(click_event.ydata), int(release_event.ydata)])
+        selected, ok = self.select_pollen_class()
+        if ok:
+            self.add_manual_box([x1, y1, x2, y2], selected, [])
+
+    def select_pollen_class(self):
+        if self.fast_mode:
+            return self.recent_classes[0], True
         selected, ok = QInputDialog.getItem(
             self,
             'Annotate Bounding Box',
             'Select pollen class:',
-            POLLEN_CLASSES
+            POLLEN_CLASSES,
+            current=POLLEN_CLASSES.index(self.recent_classes[0]) if self.recent_classes[0] in POLLEN_CLASSES else 0
         )
         if ok:
-            new_bounding_box = [[x1, y1, x2, y2], selected]
-            self.current_crop_new_boxes.append(new_bounding_box)
-            self.new_bounding_boxes_view.addItem(f'{selected} {x1, y1, x2, y2}')
-            toggle_selector.RS.clear()
-            self.annotate_image()
-            print(f'Adding box at {(x1, y1, x2, y2)} with label {selected}')
+            self.use_class(selected)
+        return selected, ok
+
+    def add_manual_box(self, bounding_box, label, undo_entry):
+        self.insert_box(BoxesType.MANUAL, len(self.current_crop_new_boxes), [bounding_box, label], undo_entry)
+        self.rectangle_selector.clear()
+        self.finish_box_change(undo_entry)
+        print(f'Adding box at {tuple(bounding_box)} with label {label}')
+
+    def get_crop_boxes(self, boxes_type):
+        return {
+            BoxesType.MANUAL: (self.current_crop_new_boxes, self.new_bounding_boxes_view),
+            BoxesType.EXISTING: (self.current_crop_existing_boxes, self.existing_bounding_boxes_view),
+            BoxesType.PROPOSED: (self.current_crop_proposed_boxes, self.proposed_bounding_boxes_view),
+        }[boxes_type]
+
+    def insert_box(self, boxes_type, index, box, undo_entry):
+        crop_boxes, boxes_view = self.get_crop_boxes(boxes_type)
+        crop_boxes.insert(index, box)
+        boxes_view.insertItem(index, f'{box[1]} {tuple(box[0])}')
+        if boxes_type != BoxesType.PROPOSED:
+            self.statistics.add_box(boxes_type, box[1])
+        undo_entry.append((self.remove_box, boxes_type, index))
+
+    def remove_box(self, boxes_type, index, undo_entry):
+        crop_boxes, boxes_view = self.get_crop_boxes(boxes_type)
+        box = crop_boxes.pop(index)
+        boxes_view.takeItem(index)
+        if boxes_type != BoxesType.PROPOSED:
+            self.statistics.remove_box(boxes_type, box[1])
+        undo_entry.append((self.insert_box, boxes_type, index, box))
+        return box
+
+    def finish_box_change(self, undo_entry):
+        self.undo_stack.append(undo_entry)
+        self.highlighted_box = None
+        self.show_statistics()
+        self.annotate_image()
+
+    def undo(self):
+        if not self.undo_stack:
+            return
+        for operation, *arguments in reversed(self.undo_stack.pop()):
+            operation(*arguments, [])
+        self.highlighted_box = None
+        self.show_statistics()
+        self.annotate_image()
+
+    def set_fast_mode(self, fast_mode):
+        self.fast_mode = fast_mode
+        self.set_class_palette()
+
+    def toggle_fast_mode(self):
+        self.fast_mode_button.toggle()
+
+    def activate_selector(self):
+        if self.rectangle_selector is not None and not self.rectangle_selector.active:
+            print(' RectangleSelector activated.')
+            self.rectangle_selector.set_active(True)
+
+    def deactivate_selector(self):
+        if self.rectangle_selector is not None and self.rectangle_selector.active:
+            print(' RectangleSelector deactivated.')
+            self.rectangle_selector.set_active(False)
+
+    def use_class(self, pollen_class):
+        if pollen_class in self.recent_classes:
+            self.recent_classes.remove(pollen_class)
+        self.recent_classes.insert(0, pollen_class)
+        self.set_class_palette()
+
+    def select_palette_class(self, palette_index):
+        if self.fast_mode and palette_index < len(self.recent_classes):
+            self.use_class(self.recent_classes[palette_index])
+
+    def choose_current_class(self):
+        if not self.fast_mode:
+            return
+        selected, ok = QInputDialog.getItem(self, 'Current Class', 'Select pollen class:', POLLEN_CLASSES)
+        if ok:
+            self.use_class(selected)
+
+    def set_class_palette(self):
+        if not self.fast_mode:
+            self.class_palette.setText('')
+            return
+        palette = [f'{key}: {pollen_class}' for key, pollen_class in zip(self.PALETTE_KEYS, self.recent_classes)]
+        self.class_palette.setText('\n'.join([
+            f'Current class: {self.recent_classes[0]}',
+            *palette,
+            'C: other class, R: relabel, D: delete, Ctrl+Z: undo',
+        ]))
 
     @staticmethod
     def add_bounding_box(bounding_box, label, color, ax):
@@ -383,7 +688,7 @@ class Window(QtWidgets.QWidget):
         self.ax = self.figure.add_subplot(111)
         self.ax.set_xticks([])
         self.ax.set_yticks([])
-        self.ax.imshow(self.current_crop, cmap='gray')
+        self.ax.imshow(self.current_display_crops[self.current_crop_index], cmap='gray', vmin=0, vmax=255)
 
         for index, (current_bounding_box, current_label) in enumerate(self.current_crop_existing_boxes):
             if index is not None and index == highlighted_index and highlight_type == BoxesType.EXISTING:
@@ -399,14 +704,19 @@ class Window(QtWidgets.QWidget):
             current_bounding_box = row[0]
             current_label = row[1]
             self.add_bounding_box(current_bounding_box, current_label, color, self.ax)
+        for index, (current_bounding_box, current_label) in enumerate(self.current_crop_proposed_boxes or []):
+            if index == highlighted_index and highlight_type == BoxesType.PROPOSED:
+                color = 'blue'
+            else:
+                color = 'yellow'
+            self.add_bounding_box(current_bounding_box, current_label, color, self.ax)
 
-        toggle_selector.RS = RectangleSelector(self.ax, self.line_select_callback,
-                                               useblit=True,
-                                               button=[1, 3],  # don't use middle button
-                                               minspanx=5, minspany=5,
-                                               spancoords='pixels',
-                                               interactive=True)
-        self.canvas.mpl_connect('key_press_event', toggle_selector)
+        self.rectangle_selector = RectangleSelector(self.ax, self.line_select_callback,
+                                                    useblit=True,
+                                                    button=[1, 3],  # don't use middle button
+                                                    minspanx=5, minspany=5,
+                                                    spancoords='pixels',
+                                                    interactive=True)
         self.canvas.draw()
 
     def skip_image(self):
@@ -417,9 +727,9 @@ class Window(QtWidgets.QWidget):
         self._show_next_image()
 
     def _show_next_image(self, previous_button_enabled=True, from_folder=None):
+        self.save_bounding_boxes()
         self.existing_bounding_boxes_view.clear()
         self.new_bounding_boxes_view.clear()
-        self.save_bounding_boxes()
         try:
             if from_folder is not None:
                 self.current_crop_index = -1
@@ -444,9 +754,9 @@ class Window(QtWidgets.QWidget):
         self._show_previous_image()
 
     def _show_previous_image(self, next_button_enabled=True):
+        self.save_bounding_boxes()
         self.existing_bounding_boxes_view.clear()
         self.new_bounding_boxes_view.clear()
-        self.save_bounding_boxes()
         try:
             # Skip images with no structure.
             while self.set_previous_crop():
@@ -464,30 +774,148 @@ class Window(QtWidgets.QWidget):
                 self.show_previous_image()
 
     def show_current_crop(self):
+        # Register the crop before any edit so that box changes are counted on top of its initial boxes.
+        if self.build_crop_path() not in self.internal_boxes:
+            self.save_bounding_boxes()
         existing_labels = [f'{box[1]} {tuple(box[0])}' for box in self.current_crop_existing_boxes]
         new_labels = [f'{box[1]} {tuple(box[0])}' for box in self.current_crop_new_boxes]
         self.existing_bounding_boxes_view.addItems(existing_labels)
         self.new_bounding_boxes_view.addItems(new_labels)
+        self.proposed_bounding_boxes_view.clear()
+        self.current_crop_proposed_boxes = None
+        self.highlighted_box = None
+        self.undo_stack = []
+        self.request_proposals()
+        self.update_proposed_boxes(redraw=False)
         self.backup_counter += 1
         backup = self.backup_counter % self.BACKUP_INTERVAL == 0
         self.persist_state(backup)
 
         self.header.setText(f'{self.current_probe_directory}/images/{self.current_crop_name}')
+        self.show_statistics()
         self.annotate_image()
 
+    def show_statistics(self):
+        reviewed = self.statistics.reviewed
+        skipped = self.statistics.skipped
+        tiles_per_hour, boxes_per_hour = self.statistics.session_rates()
+        overall_boxes_per_hour, annotation_hours = self.statistics.overall_rate()
+        self.progress_label.setText('\n'.join([
+            f'This probe: {reviewed[self.current_probe_directory]} of {len(self.current_crops)} tiles reviewed, '
+            f'{skipped[self.current_probe_directory]} skipped',
+            f'All probes: {sum(reviewed.values())} tiles reviewed, {sum(skipped.values())} skipped',
+            f'Session: {tiles_per_hour:.0f} tiles/h, {boxes_per_hour:.0f} boxes/h',
+            f'Overall: {overall_boxes_per_hour:.0f} boxes/h in {annotation_hours:.1f} h',
+        ]))
+        manual_counts = self.statistics.class_counts[BoxesType.MANUAL]
+        existing_counts = self.statistics.class_counts[BoxesType.EXISTING]
+        labels = sorted(
+            [label for label in set(manual_counts) | set(existing_counts) if manual_counts[label] or existing_counts[label]],
+            key=lambda label: -(manual_counts[label] + existing_counts[label])
+        )
+        self.class_statistics_view.clear()
+        self.class_statistics_view.addItems(
+            [f'{label}: {manual_counts[label]} new, {existing_counts[label]} existing' for label in labels]
+        )
+
+    def request_proposals(self):
+        crop_paths = []
+        last_index = min(self.current_crop_index + self.PROPOSAL_LOOKAHEAD, len(self.current_crops))
+        if self.client is not None:
+            # Remote tiles are downloaded in the background, their proposals are requested once they arrived.
+            self.current_crops.prefetch(range(self.current_crop_index, last_index))
+        for index in range(self.current_crop_index, last_index):
+            if self.client is not None:
+                crop = self.current_crops.get_loaded(index)
+            else:
+                crop = self.current_crops[index]
+            if crop is None or crop.min() == crop.max():
+                continue
+            crop_path = self.build_crop_path(self.current_crop_names[index])
+            self.proposal_generator.submit(crop_path, crop)
+            crop_paths.append(crop_path)
+        self.proposal_generator.discard_pending(keep=crop_paths)
+
+    def poll_proposals(self):
+        if self.client is not None and self.current_crop_name is not None:
+            self.request_proposals()
+        self.update_proposed_boxes()
+
+    def update_proposed_boxes(self, redraw=True):
+        if self.current_crop_proposed_boxes is not None or self.current_crop_name is None:
+            return
+        proposed_boxes = self.proposal_generator.get(self.build_crop_path())
+        if proposed_boxes is None:
+            return
+        self.current_crop_proposed_boxes = remove_overlapping_boxes(
+            proposed_boxes,
+            self.current_crop_existing_boxes + self.current_crop_new_boxes,
+            PROPOSAL_IOU_THRESHOLD
+        )
+        self.proposed_bounding_boxes_view.addItems([f'{box[1]} {tuple(box[0])}' for box in self.current_crop_proposed_boxes])
+        if redraw:
+            self.annotate_image()
+
     def save_bounding_boxes(self):
+        if self.current_crop_name is None:
+            return
+        crop_path = self.build_crop_path()
         boxes = {
             BoxesType.MANUAL.value: self.current_crop_new_boxes,
             BoxesType.EXISTING.value: self.current_crop_existing_boxes,
             'skip': self.current_crop_skip,
         }
-        self.internal_boxes[self.build_crop_path()] = boxes
+        previous_boxes = self.internal_boxes.get(crop_path)
+        if previous_boxes is None:
+            self.statistics.add_crop(crop_path, boxes)
+        elif self.current_crop_skip and not previous_boxes['skip']:
+            self.statistics.skip_crop(crop_path)
+        self.internal_boxes[crop_path] = boxes
+        if self.client is not None:
+            self.upload_annotations({crop_path: boxes})
+
+    def upload_annotations(self, annotations: dict):
+        # The server keeps the shared counts of all annotators, the local ones are replaced by its totals.
+        conflicts, statistics = self.client.update_annotations(annotations)
+        if statistics is not None:
+            self.statistics.load_aggregates(statistics)
+        if not conflicts:
+            return
+        for crop_path, boxes in conflicts.items():
+            self.internal_boxes.pop(crop_path, None)
+            if boxes is not None:
+                self.internal_boxes[crop_path] = boxes
+        current_boxes = conflicts.get(self.build_crop_path())
+        if current_boxes is not None:
+            self.current_crop_new_boxes = current_boxes[BoxesType.MANUAL.value]
+            self.current_crop_existing_boxes = current_boxes[BoxesType.EXISTING.value]
+            self.current_crop_skip = current_boxes['skip']
+            # The list rows must match the replaced boxes, otherwise deleting or relabeling hits the wrong box.
+            self.existing_bounding_boxes_view.clear()
+            self.new_bounding_boxes_view.clear()
+            self.show_current_crop()
+        QMessageBox.warning(
+            self,
+            'Annotation Conflict',
+            'Another annotator saved these images first, your changes to them were replaced by theirs:\n'
+            + '\n'.join(conflicts)
+        )
 
     def persist_state(self, backup=False):
+        if self.client is not None:
+            self.client.update_position({
+                'current_crop_index': self.current_crop_index,
+                'current_probe_directory': self.current_probe_directory,
+                'recent_classes': self.recent_classes,
+                'annotator_statistics': self.statistics.annotator_to_dict(),
+            })
+            return
         state = {
             'current_crop_index': self.current_crop_index,
             'current_probe_directory': self.current_probe_directory,
-            'internal_boxes': self.internal_boxes
+            'internal_boxes': self.internal_boxes,
+            'recent_classes': self.recent_classes,
+            'statistics': self.statistics.to_dict(),
         }
         saved_state_file = Path(f'{self.processing_directory}/{self.SAVED_STATE_FILE_NAME}')
         if backup:
@@ -500,19 +928,62 @@ class Window(QtWidgets.QWidget):
 
     def load_state(self):
         try:
-            with open(f'{self.processing_directory}/{self.SAVED_STATE_FILE_NAME}', 'r') as file:
-                saved_state = json.load(file)
+            if self.client is not None:
+                saved_state = self.client.get_state()
+            else:
+                with open(f'{self.processing_directory}/{self.SAVED_STATE_FILE_NAME}', 'r') as file:
+                    saved_state = json.load(file)
             self.current_crop_index = saved_state['current_crop_index']
             self.current_probe_directory = saved_state['current_probe_directory']
             self.internal_boxes = saved_state['internal_boxes']
+            self.recent_classes = saved_state.get('recent_classes', self.recent_classes)
+            if 'statistics' in saved_state:
+                self.statistics = AnnotationStatistics(saved_state['statistics'])
+            else:
+                self.statistics = AnnotationStatistics.from_internal_boxes(self.internal_boxes)
         except FileNotFoundError:
             print('No previously save state exists, yet.')
             self.current_crop_index = 0
             self.current_probe_directory = self.probe_directories[0]
             self.internal_boxes = {}
 
-    def export_csv(self):
+    def check_bounding_boxes(self, include_relabeled=False):
         self.save_bounding_boxes()
+        if self.client is not None:
+            self.refresh_internal_boxes()
+        findings = find_box_issues(self.internal_boxes, include_relabeled=include_relabeled)
+        if not findings:
+            print('No problematic bounding boxes found.')
+            return
+        findings_dialog = BoxFindingsDialog(findings, self)
+        if findings_dialog.exec():
+            changed_crop_paths = fix_box_issues(
+                self.internal_boxes,
+                remove_relabeled=findings_dialog.remove_relabeled_checkbox.isChecked(),
+            )
+            print(f'Fixed bounding boxes in {len(changed_crop_paths)} images.')
+            if self.client is not None:
+                self.upload_annotations(
+                    {crop_path: self.internal_boxes[crop_path] for crop_path in changed_crop_paths}
+                )
+            else:
+                self.statistics.recount(self.internal_boxes)
+            self.existing_bounding_boxes_view.clear()
+            self.new_bounding_boxes_view.clear()
+            self.show_current_crop()
+
+    def refresh_internal_boxes(self):
+        # The local boxes only cover crops this client visited, checks and exports need everyone's work.
+        crop_path = self.build_crop_path()
+        current_boxes = self.internal_boxes.get(crop_path)
+        state = self.client.get_state()
+        self.internal_boxes = state['internal_boxes']
+        if current_boxes is not None:
+            self.internal_boxes[crop_path] = current_boxes
+        self.statistics.load_aggregates(state['statistics'])
+
+    def export_csv(self):
+        self.check_bounding_boxes()
         export_directory, _ = QFileDialog.getSaveFileName(
             self,
             "Export New Annotations",
@@ -538,6 +1009,9 @@ class Window(QtWidgets.QWidget):
                 label.append(box[1])
                 updated.append(True)
                 skipped.append(skip)
+        # Only needed for exporting, so pandas does not slow down startup.
+        import pandas as pd
+
         bounding_boxes = np.array(bounding_boxes)
         label_info = pd.DataFrame({
             'file_path': file_paths,
@@ -557,8 +1031,10 @@ class Window(QtWidgets.QWidget):
         )
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
-        self.save_bounding_boxes()
-        self.persist_state(backup=True)
+        # Before startup finished, the state in memory is incomplete and must not overwrite the saved one.
+        if self.startup_finished:
+            self.save_bounding_boxes()
+            self.persist_state(backup=True)
         close_dialog = QDialog()
         close_dialog.setWindowTitle('Close Application')
 
@@ -574,25 +1050,33 @@ class Window(QtWidgets.QWidget):
         close_dialog.layout.addWidget(close_dialog.buttonBox)
         close_dialog.setLayout(close_dialog.layout)
         if close_dialog.exec():
+            self.proposal_timer.stop()
+            self.proposal_generator.shutdown()
             a0.accept()
         else:
             a0.ignore()
 
 
-def toggle_selector(self, event):
-    print(' Key pressed.', event.key)
-    if event.key in ['Q', 'q'] and self.toggle_selector.RS.active:
-        print(' RectangleSelector deactivated.')
-        self.toggle_selector.RS.set_active(False)
-    if event.key in ['A', 'a'] and not self.toggle_selector.RS.active:
-        print(' RectangleSelector activated.')
-        self.toggle_selector.RS.set_active(True)
+def show_unhandled_exception(exception_type, exception, exception_traceback):
+    if issubclass(exception_type, AnnotationServerError):
+        QMessageBox.critical(None, 'Annotation Server Error', str(exception))
+    else:
+        sys.__excepthook__(exception_type, exception, exception_traceback)
 
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    # The CPU time used so far covers the interpreter start and the imports, so the reported startup time includes them.
+    startup_time = time.perf_counter() - time.process_time()
+    parser = argparse.ArgumentParser(description='Annotate pollen grains in tiled TIFF maps.')
+    parser.add_argument('--server', help='URL of a running annotation_server.py, e.g. http://127.0.0.1:8765')
+    parser.add_argument('--annotator', default=getpass.getuser(), help='name under which the server keeps your position')
+    arguments, qt_arguments = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_arguments)
+    sys.excepthook = show_unhandled_exception
 
-    main = Window()
+    main = Window(server_url=arguments.server, annotator=arguments.annotator, startup_time=startup_time)
     main.show()
+    QTimer.singleShot(0, main.report_window_startup)
 
     sys.exit(app.exec())
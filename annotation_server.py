@@ -0,0 +1,420 @@
+import argparse
+import concurrent.futures
+import http.client
+import io
+import json
+import os
+import shutil
+import threading
+import traceback
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+from annotation_statistics import AnnotationStatistics
+from display import compute_display_limits
+from process_tif_map import crop_probe_directory
+
+SAVED_STATE_FILE_NAME = 'saved_state.json'
+BACKUP_DIRECTORY = 'backups'
+BACKUP_INTERVAL = 100
+SAVE_INTERVAL = 5
+MAX_CACHED_PROBES = 3
+CLIENT_TILE_CACHE_SIZE = 16
+CLIENT_DOWNLOAD_WORKERS = 2
+REQUEST_TIMEOUT = 60
+POSITION_KEYS = ['current_crop_index', 'current_probe_directory', 'recent_classes']
+
+
+class AnnotationServerError(Exception):
+    pass
+
+
+class AnnotationStore:
+    def __init__(self, processing_directory: str):
+        self.processing_directory = processing_directory
+        self.probe_directories = sorted(
+            directory for directory in next(os.walk(processing_directory))[1] if directory != BACKUP_DIRECTORY
+        )
+
+        self.saved_state_file = Path(f'{processing_directory}/{SAVED_STATE_FILE_NAME}')
+        try:
+            with open(self.saved_state_file, 'r') as file:
+                self.state = json.load(file)
+        except FileNotFoundError:
+            print('No previously save state exists, yet.')
+            self.state = {
+                'current_crop_index': 0,
+                'current_probe_directory': self.probe_directories[0],
+                'internal_boxes': {},
+            }
+        self.state.setdefault('crop_versions', {})
+        self.state.setdefault('annotators', {})
+        if 'statistics' in self.state:
+            self.statistics = AnnotationStatistics(self.state['statistics'])
+        else:
+            self.statistics = AnnotationStatistics.from_internal_boxes(self.state['internal_boxes'])
+        self.state_lock = threading.Lock()
+        self.crop_locks = defaultdict(threading.Lock)
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        self.save_counter = 0
+
+        self.probes = OrderedDict()
+        self.probes_lock = threading.Lock()
+        self.probe_locks = defaultdict(threading.Lock)
+
+    def get_probe(self, probe_directory: str):
+        with self.probes_lock:
+            probe_lock = self.probe_locks[probe_directory]
+        # Tiling a probe is expensive, so concurrent requests for the same probe wait for a single decode.
+        with probe_lock:
+            with self.probes_lock:
+                if probe_directory in self.probes:
+                    self.probes.move_to_end(probe_directory)
+                    return self.probes[probe_directory]
+            crops, crop_names, existing_bounding_boxes = crop_probe_directory(self.processing_directory, probe_directory)
+            probe = {
+                'crops': crops,
+                'crop_names': crop_names,
+                'existing_boxes': existing_bounding_boxes,
+                'display_limits': compute_display_limits(crops) if crops else None,
+                # Clients skip blank tiles without downloading them, so their fill value is sent with the probe.
+                'blank_values': [crop.flat[0].item() if crop.min() == crop.max() else None for crop in crops],
+            }
+            with self.probes_lock:
+                self.probes[probe_directory] = probe
+                while len(self.probes) > MAX_CACHED_PROBES:
+                    self.probes.popitem(last=False)
+            return probe
+
+    def get_state(self, annotator: str):
+        with self.state_lock:
+            annotator_state = self.state['annotators'].get(annotator, {})
+            return json.dumps({
+                **self.state,
+                **{key: annotator_state[key] for key in POSITION_KEYS if key in annotator_state},
+                'statistics': {
+                    **self.statistics.aggregates_to_dict(),
+                    **annotator_state.get('annotator_statistics', {}),
+                },
+            })
+
+    def get_annotations(self, crop_path: str):
+        with self.state_lock:
+            return json.dumps({
+                'boxes': self.state['internal_boxes'].get(crop_path),
+                'version': self.state['crop_versions'].get(crop_path, 0),
+            })
+
+    def update_annotations(self, annotations: dict):
+        versions = {}
+        conflicts = {}
+        for crop_path, update in annotations.items():
+            # An update is only accepted if it was based on the latest version of the crop, otherwise it would
+            # silently overwrite boxes another annotator saved in the meantime.
+            with self._crop_lock(crop_path):
+                version = self.state['crop_versions'].get(crop_path, 0)
+                # Unchanged boxes are accepted without a new version, so merely viewing a crop cannot make the
+                # next save of another annotator conflict.
+                if update['boxes'] == self.state['internal_boxes'].get(crop_path):
+                    versions[crop_path] = version
+                    continue
+                if update['version'] != version:
+                    conflicts[crop_path] = {
+                        'boxes': self.state['internal_boxes'].get(crop_path),
+                        'version': version,
+                    }
+                    continue
+                with self.state_lock:
+                    previous_boxes = self.state['internal_boxes'].get(crop_path)
+                    if previous_boxes is not None:
+                        self.statistics.remove_crop(crop_path, previous_boxes)
+                    self.statistics.add_crop(crop_path, update['boxes'], count_session=False)
+                    self.state['internal_boxes'][crop_path] = update['boxes']
+                    self.state['crop_versions'][crop_path] = version + 1
+                    self.dirty = True
+                versions[crop_path] = version + 1
+        with self.state_lock:
+            statistics = self.statistics.aggregates_to_dict()
+        return json.dumps({'versions': versions, 'conflicts': conflicts, 'statistics': statistics})
+
+    def update_position(self, annotator: str, position: dict):
+        shared_position = {key: position[key] for key in POSITION_KEYS if key in position}
+        with self.state_lock:
+            self.state['annotators'][annotator] = {
+                **shared_position,
+                'annotator_statistics': position.get('annotator_statistics', {}),
+            }
+            self.state.update(shared_position)
+            self.dirty = True
+
+    def _crop_lock(self, crop_path):
+        with self.state_lock:
+            return self.crop_locks[crop_path]
+
+    def save(self, backup=False):
+        with self.save_lock:
+            with self.state_lock:
+                if not self.dirty and not backup:
+                    return
+                self.state['statistics'] = self.statistics.aggregates_to_dict()
+                state = json.dumps(self.state)
+                self.dirty = False
+            self.save_counter += 1
+            if (backup or self.save_counter % BACKUP_INTERVAL == 0) and self.saved_state_file.exists():
+                backup_directory = Path(f'{self.processing_directory}/{BACKUP_DIRECTORY}')
+                backup_directory.mkdir(exist_ok=True)
+                saved_state_backup_file = backup_directory / f'{datetime.now().timestamp()}_{SAVED_STATE_FILE_NAME}'
+                shutil.copy(self.saved_state_file, saved_state_backup_file)
+            with open(self.saved_state_file, 'w') as file:
+                file.write(state)
+
+
+class AnnotationRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._handle(self._get)
+
+    def do_POST(self):
+        self._handle(self._post)
+
+    def _handle(self, handler):
+        # Errors are answered with a status code instead of dropping the connection, so clients can report them.
+        try:
+            handler()
+        except json.JSONDecodeError as error:
+            self.send_error(400, f'Invalid JSON: {error}')
+        except Exception as error:
+            traceback.print_exc()
+            self.send_error(500, f'{type(error).__name__}: {error}'.replace('\n', ' '))
+
+    def _get(self):
+        url = urllib.parse.urlparse(self.path)
+        parts = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/')]
+        store = self.server.store
+        if parts == ['probes']:
+            self._send_json(json.dumps(store.probe_directories))
+        elif parts == ['state']:
+            annotator = urllib.parse.parse_qs(url.query).get('annotator', [''])[0]
+            self._send_json(store.get_state(annotator))
+        elif parts == ['annotations']:
+            crop_path = urllib.parse.parse_qs(url.query).get('crop_path', [''])[0]
+            self._send_json(store.get_annotations(crop_path))
+        elif len(parts) >= 2 and parts[0] == 'probes' and parts[1] in store.probe_directories:
+            probe = store.get_probe(parts[1])
+            if len(parts) == 2:
+                self._send_json(json.dumps({
+                    'n_crops': len(probe['crops']),
+                    'crop_names': probe['crop_names'],
+                    'existing_boxes': probe['existing_boxes'],
+                    'display_limits': probe['display_limits'],
+                    'blank_values': probe['blank_values'],
+                    'tile_shape': probe['crops'][0].shape if probe['crops'] else None,
+                    'tile_dtype': str(probe['crops'][0].dtype) if probe['crops'] else None,
+                }))
+            elif len(parts) == 4 and parts[2] == 'tiles' and parts[3].isdigit() and int(parts[3]) < len(probe['crops']):
+                tile = io.BytesIO()
+                np.save(tile, probe['crops'][int(parts[3])], allow_pickle=False)
+                self._send(tile.getvalue(), 'application/octet-stream')
+            else:
+                self.send_error(404)
+        else:
+            self.send_error(404)
+
+    def _post(self):
+        parts = self.path.strip('/').split('/')
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if parts == ['annotations']:
+            self._send_json(self.server.store.update_annotations(payload))
+        elif parts == ['state']:
+            self.server.store.update_position(payload.pop('annotator'), payload)
+            self._send_json('{}')
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body: str):
+        self._send(body.encode(), 'application/json')
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RemoteCrops:
+    def __init__(
+            self,
+            client,
+            probe_directory: str,
+            blank_values: list,
+            tile_shape: tuple,
+            tile_dtype: str,
+    ):
+        self.client = client
+        self.probe_directory = probe_directory
+        self.n_crops = len(blank_values)
+        self.blank_values = blank_values
+        self.tile_shape = tile_shape
+        self.dtype = np.dtype(tile_dtype) if tile_dtype is not None else None
+        self.cache = OrderedDict()
+        self.pending = {}
+
+    def __len__(self):
+        return self.n_crops
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += self.n_crops
+        if not 0 <= index < self.n_crops:
+            raise IndexError('crop index out of range')
+        if self.blank_values[index] is not None:
+            return np.full(self.tile_shape, self.blank_values[index], dtype=self.dtype)
+        if index in self.cache:
+            self.cache.move_to_end(index)
+        else:
+            future = self.pending.pop(index, None)
+            if future is not None:
+                self.cache[index] = future.result()
+            else:
+                self.cache[index] = self.client.get_tile(self.probe_directory, index)
+            while len(self.cache) > CLIENT_TILE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return self.cache[index]
+
+    def prefetch(self, indices):
+        for index in list(self.pending.keys()):
+            if index not in indices and self.pending[index].cancel():
+                del self.pending[index]
+        for index in indices:
+            if self.blank_values[index] is None and index not in self.cache and index not in self.pending:
+                self.pending[index] = self.client.download_executor.submit(
+                    self.client.get_tile, self.probe_directory, index
+                )
+
+    def get_loaded(self, index: int):
+        # Unlike indexing, this never waits for a download.
+        future = self.pending.get(index)
+        if future is not None and not future.done():
+            return None
+        if self.blank_values[index] is None and index not in self.cache and future is None:
+            return None
+        return self[index]
+
+
+class AnnotationClient:
+    def __init__(self, server_url: str, annotator: str):
+        self.server_url = server_url.rstrip('/')
+        self.annotator = annotator
+        self.crop_versions = {}
+        self.crop_boxes = {}
+        self.download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=CLIENT_DOWNLOAD_WORKERS)
+
+    def get_probe_directories(self):
+        return json.loads(self._request('GET', '/probes'))
+
+    def get_probe(self, probe_directory: str):
+        probe = json.loads(self._request('GET', f'/probes/{urllib.parse.quote(probe_directory)}'))
+        crops = RemoteCrops(self, probe_directory, probe['blank_values'], probe['tile_shape'], probe['tile_dtype'])
+        display_limits = tuple(probe['display_limits']) if probe['display_limits'] is not None else None
+        return crops, probe['crop_names'], probe['existing_boxes'], display_limits
+
+    def get_tile(self, probe_directory: str, index: int):
+        tile = self._request('GET', f'/probes/{urllib.parse.quote(probe_directory)}/tiles/{index}')
+        return np.load(io.BytesIO(tile), allow_pickle=False)
+
+    def get_state(self):
+        state = json.loads(self._request('GET', f'/state?annotator={urllib.parse.quote(self.annotator)}'))
+        self.crop_versions = state['crop_versions']
+        return state
+
+    def get_annotations(self, crop_path: str):
+        annotations = json.loads(self._request('GET', f'/annotations?crop_path={urllib.parse.quote(crop_path)}'))
+        self.crop_versions[crop_path] = annotations['version']
+        self.crop_boxes[crop_path] = json.dumps(annotations['boxes'])
+        return annotations['boxes']
+
+    def update_annotations(self, annotations: dict):
+        # The fetched boxes are kept serialized because the window edits the returned lists in place.
+        annotations = {
+            crop_path: boxes for crop_path, boxes in annotations.items()
+            if json.dumps(boxes) != self.crop_boxes.get(crop_path)
+        }
+        if not annotations:
+            return {}, None
+        response = json.loads(self._request('POST', '/annotations', {
+            crop_path: {'boxes': boxes, 'version': self.crop_versions.get(crop_path, 0)}
+            for crop_path, boxes in annotations.items()
+        }))
+        self.crop_versions.update(response['versions'])
+        for crop_path in response['versions']:
+            self.crop_boxes[crop_path] = json.dumps(annotations[crop_path])
+        conflicts = {}
+        for crop_path, conflict in response['conflicts'].items():
+            self.crop_versions[crop_path] = conflict['version']
+            self.crop_boxes[crop_path] = json.dumps(conflict['boxes'])
+            conflicts[crop_path] = conflict['boxes']
+        return conflicts, response['statistics']
+
+    def update_position(self, position: dict):
+        self._request('POST', '/state', {'annotator': self.annotator, **position})
+
+    def _request(self, method: str, path: str, payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(
+            f'{self.server_url}{path}',
+            data=data,
+            method=method,
+            headers={'Content-Type': 'application/json'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                return response.read()
+        except urllib.error.HTTPError as error:
+            raise AnnotationServerError(f'{method} {path} failed with {error.code}: {error.reason}') from error
+        except (OSError, http.client.HTTPException) as error:
+            raise AnnotationServerError(f'{method} {path} failed: {error}') from error
+
+
+def serve(
+        processing_directory: str,
+        host: str = '127.0.0.1',
+        port: int = 8765,
+):
+    server = ThreadingHTTPServer((host, port), AnnotationRequestHandler)
+    server.store = AnnotationStore(processing_directory)
+    stop_saving = threading.Event()
+
+    def save_periodically():
+        while not stop_saving.wait(SAVE_INTERVAL):
+            server.store.save()
+
+    threading.Thread(target=save_periodically, daemon=True).start()
+    print(f'Serving {processing_directory} on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_saving.set()
+        server.server_close()
+        server.store.save(backup=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve tiles and annotations of a processing directory locally.')
+    parser.add_argument('processing_directory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    arguments = parser.parse_args()
+    serve(arguments.processing_directory, arguments.host, arguments.port)
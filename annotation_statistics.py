@@ -0,0 +1,100 @@
+import time
+from collections import Counter
+
+from bounding_boxes import BoxesType
+
+COUNTED_BOXES_TYPES = [BoxesType.MANUAL, BoxesType.EXISTING]
+
+
+class AnnotationStatistics:
+    def __init__(self, statistics: dict = None):
+        statistics = statistics or {}
+        self.load_aggregates(statistics)
+        # Time and boxes belong to a single annotator, unlike the aggregates they are not shared between clients.
+        self.annotation_seconds = statistics.get('annotation_seconds', 0.0)
+        self.annotated_boxes = statistics.get('annotated_boxes', 0)
+
+        self.session_start = time.monotonic()
+        self.session_reviewed = 0
+        self.session_boxes = 0
+
+    def load_aggregates(self, statistics: dict):
+        self.reviewed = Counter(statistics.get('reviewed', {}))
+        self.skipped = Counter(statistics.get('skipped', {}))
+        self.class_counts = {
+            boxes_type: Counter(statistics.get('class_counts', {}).get(boxes_type.value, {}))
+            for boxes_type in COUNTED_BOXES_TYPES
+        }
+
+    @classmethod
+    def from_internal_boxes(cls, internal_boxes: dict):
+        statistics = cls()
+        statistics.recount(internal_boxes)
+        return statistics
+
+    def recount(self, internal_boxes: dict):
+        self.reviewed.clear()
+        self.skipped.clear()
+        for class_counts in self.class_counts.values():
+            class_counts.clear()
+        for crop_path, boxes in internal_boxes.items():
+            self.add_crop(crop_path, boxes, count_session=False)
+
+    def add_crop(self, crop_path: str, boxes: dict, count_session=True):
+        probe_directory = crop_path.split('/')[0]
+        self.reviewed[probe_directory] += 1
+        if boxes['skip']:
+            self.skipped[probe_directory] += 1
+        for boxes_type in COUNTED_BOXES_TYPES:
+            self.class_counts[boxes_type].update(box[1] for box in boxes[boxes_type.value])
+        if count_session:
+            self.session_reviewed += 1
+
+    def remove_crop(self, crop_path: str, boxes: dict):
+        probe_directory = crop_path.split('/')[0]
+        self.reviewed[probe_directory] -= 1
+        if boxes['skip']:
+            self.skipped[probe_directory] -= 1
+        for boxes_type in COUNTED_BOXES_TYPES:
+            self.class_counts[boxes_type].subtract(box[1] for box in boxes[boxes_type.value])
+
+    def skip_crop(self, crop_path: str):
+        self.skipped[crop_path.split('/')[0]] += 1
+
+    def add_box(self, boxes_type: BoxesType, label: str):
+        self.class_counts[boxes_type][label] += 1
+        if boxes_type == BoxesType.MANUAL:
+            self.session_boxes += 1
+
+    def remove_box(self, boxes_type: BoxesType, label: str):
+        self.class_counts[boxes_type][label] -= 1
+        if boxes_type == BoxesType.MANUAL:
+            self.session_boxes -= 1
+
+    def session_rates(self):
+        session_hours = max(time.monotonic() - self.session_start, 1.0) / 3600
+        return self.session_reviewed / session_hours, self.session_boxes / session_hours
+
+    def overall_rate(self):
+        annotator = self.annotator_to_dict()
+        annotation_hours = max(annotator['annotation_seconds'], 1.0) / 3600
+        return annotator['annotated_boxes'] / annotation_hours, annotation_hours
+
+    def to_dict(self):
+        return {**self.aggregates_to_dict(), **self.annotator_to_dict()}
+
+    def aggregates_to_dict(self):
+        return {
+            'reviewed': dict(self.reviewed),
+            'skipped': dict(self.skipped),
+            'class_counts': {
+                boxes_type.value: {label: count for label, count in self.class_counts[boxes_type].items() if count}
+                for boxes_type in COUNTED_BOXES_TYPES
+            },
+        }
+
+    def annotator_to_dict(self):
+        return {
+            'annotation_seconds': self.annotation_seconds + time.monotonic() - self.session_start,
+            'annotated_boxes': self.annotated_boxes + self.session_boxes,
+        }
@@ -0,0 +1,202 @@
+from collections import defaultdict
+from enum import Enum
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from process_tif_map import IMAGE_WIDTH, IMAGE_HEIGHT
+
+DUPLICATE_IOU_THRESHOLD = 0.8
+
+
+class BoxesType(Enum):
+    MANUAL = 'manual_boxes'
+    EXISTING = 'existing_boxes'
+    PROPOSED = 'proposed_boxes'
+
+
+# Existing boxes come first, so in every overlapping manual/existing pair the existing box is the first one.
+CHECKED_BOXES_TYPES = [BoxesType.EXISTING, BoxesType.MANUAL]
+
+
+class BoxIssue(Enum):
+    INVERTED = 'inverted'
+    ZERO_AREA = 'zero area'
+    OUT_OF_BOUNDS = 'out of bounds'
+    DUPLICATE = 'duplicate of'
+    RELABELED = 'relabeled by'
+
+
+class BoxFinding(NamedTuple):
+    crop_path: str
+    boxes_type: BoxesType
+    index: int
+    issue: BoxIssue
+    other_box: Optional[tuple] = None
+
+    def __str__(self):
+        text = f'{self.crop_path} {self.boxes_type.value}[{self.index}]: {self.issue.value}'
+        if self.other_box is not None:
+            other_type, other_index = self.other_box
+            text += f' {other_type.value}[{other_index}]'
+        return text
+
+
+def pairwise_iou(
+        boxes_a: np.ndarray,
+        boxes_b: np.ndarray,
+):
+    x1 = np.maximum(boxes_a[:, 0], boxes_b[:, 0])
+    y1 = np.maximum(boxes_a[:, 1], boxes_b[:, 1])
+    x2 = np.minimum(boxes_a[:, 2], boxes_b[:, 2])
+    y2 = np.minimum(boxes_a[:, 3], boxes_b[:, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a + area_b - intersection
+    return np.divide(intersection, union, out=np.zeros(len(union)), where=union > 0)
+
+
+def find_box_issues(
+        internal_boxes: dict,
+        iou_threshold: float = DUPLICATE_IOU_THRESHOLD,
+        include_relabeled: bool = False,
+):
+    analysis = _analyse_boxes(internal_boxes, iou_threshold)
+    findings = []
+    for issue in [BoxIssue.INVERTED, BoxIssue.OUT_OF_BOUNDS, BoxIssue.ZERO_AREA]:
+        for box in np.flatnonzero(analysis[issue]):
+            crop_path, boxes_type = _box_location(analysis, box)
+            findings.append(BoxFinding(crop_path, boxes_type, int(analysis['indices'][box]), issue))
+    # Relabeling a detection with a manual box is how annotators correct its class, so it is only reported on request.
+    pair_issues = [BoxIssue.DUPLICATE, BoxIssue.RELABELED] if include_relabeled else [BoxIssue.DUPLICATE]
+    for issue in pair_issues:
+        for box, other in analysis[issue]:
+            crop_path, boxes_type = _box_location(analysis, box)
+            _, other_type = _box_location(analysis, other)
+            findings.append(BoxFinding(
+                crop_path,
+                boxes_type,
+                int(analysis['indices'][box]),
+                issue,
+                (other_type, int(analysis['indices'][other])),
+            ))
+    return findings
+
+
+def fix_box_issues(
+        internal_boxes: dict,
+        iou_threshold: float = DUPLICATE_IOU_THRESHOLD,
+        remove_relabeled: bool = False,
+):
+    analysis = _analyse_boxes(internal_boxes, iou_threshold)
+    corrected = analysis[BoxIssue.INVERTED] | analysis[BoxIssue.OUT_OF_BOUNDS]
+    removed = analysis[BoxIssue.ZERO_AREA].copy()
+    removed[analysis[BoxIssue.DUPLICATE][:, 0]] = True
+    if remove_relabeled:
+        # A manual box with another label over a detection corrects its class, so the detection is the one removed.
+        removed[analysis[BoxIssue.RELABELED][:, 0]] = True
+    corrected &= ~removed
+
+    changed_crop_paths = set()
+    for box in np.flatnonzero(corrected):
+        crop_path, boxes_type = _box_location(analysis, box)
+        crop_boxes = internal_boxes[crop_path][boxes_type.value]
+        crop_boxes[analysis['indices'][box]][0] = analysis['boxes'][box].tolist()
+        changed_crop_paths.add(crop_path)
+
+    removed_indices = defaultdict(list)
+    for box in np.flatnonzero(removed):
+        removed_indices[_box_location(analysis, box)].append(analysis['indices'][box])
+    for (crop_path, boxes_type), indices in removed_indices.items():
+        crop_boxes = internal_boxes[crop_path][boxes_type.value]
+        for index in sorted(indices, reverse=True):
+            del crop_boxes[index]
+        changed_crop_paths.add(crop_path)
+    return changed_crop_paths
+
+
+def _analyse_boxes(internal_boxes, iou_threshold):
+    crop_paths = list(internal_boxes.keys())
+    coordinates = []
+    labels = []
+    segment_counts = []
+    for crop_path in crop_paths:
+        for boxes_type in CHECKED_BOXES_TYPES:
+            crop_boxes = internal_boxes[crop_path].get(boxes_type.value, [])
+            coordinates.extend(box[0] for box in crop_boxes)
+            labels.extend(box[1] for box in crop_boxes)
+            segment_counts.append(len(crop_boxes))
+
+    segment_counts = np.array(segment_counts, dtype=np.int64)
+    raw_boxes = np.array(coordinates, dtype=np.int64).reshape(-1, 4)
+    n_boxes = len(raw_boxes)
+    box_range = np.arange(n_boxes)
+    segments = np.repeat(np.arange(len(segment_counts)), segment_counts)
+    types = segments % len(CHECKED_BOXES_TYPES)
+    labels = np.array(labels, dtype=object)
+    segment_starts = np.cumsum(segment_counts) - segment_counts
+
+    inverted = (raw_boxes[:, 0] > raw_boxes[:, 2]) | (raw_boxes[:, 1] > raw_boxes[:, 3])
+    boxes = np.concatenate([
+        np.minimum(raw_boxes[:, :2], raw_boxes[:, 2:]),
+        np.maximum(raw_boxes[:, :2], raw_boxes[:, 2:]),
+    ], axis=1)
+    out_of_bounds = (boxes[:, :2] < 0).any(axis=1) | (boxes[:, 2] > IMAGE_WIDTH) | (boxes[:, 3] > IMAGE_HEIGHT)
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, IMAGE_WIDTH)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, IMAGE_HEIGHT)
+    zero_area = (boxes[:, 0] == boxes[:, 2]) | (boxes[:, 1] == boxes[:, 3])
+
+    # Boxes of one crop are contiguous, so every box is paired with all following boxes up to the end of its crop.
+    crop_counts = segment_counts.reshape(-1, len(CHECKED_BOXES_TYPES)).sum(axis=1)
+    partners = np.repeat(np.cumsum(crop_counts), crop_counts) - box_range - 1
+    partners[zero_area] = 0
+    first = np.repeat(box_range, partners)
+    partner_starts = np.cumsum(partners) - partners
+    second = first + 1 + np.arange(len(first)) - np.repeat(partner_starts, partners)
+    valid = ~zero_area[second]
+    first, second = first[valid], second[valid]
+    overlapping = pairwise_iou(boxes[first], boxes[second]) >= iou_threshold
+    same_label = labels[first] == labels[second]
+    relabeling = (types[first] == CHECKED_BOXES_TYPES.index(BoxesType.EXISTING)) \
+        & (types[second] == CHECKED_BOXES_TYPES.index(BoxesType.MANUAL))
+
+    return {
+        'crop_paths': crop_paths,
+        'segments': segments,
+        'indices': box_range - segment_starts[segments],
+        'boxes': boxes,
+        BoxIssue.INVERTED: inverted,
+        BoxIssue.OUT_OF_BOUNDS: out_of_bounds,
+        BoxIssue.ZERO_AREA: zero_area,
+        BoxIssue.DUPLICATE: _unique_pairs(second, first, overlapping & same_label),
+        BoxIssue.RELABELED: _unique_pairs(first, second, overlapping & ~same_label & relabeling),
+    }
+
+
+def _unique_pairs(boxes, others, selected):
+    # Every flagged box is reported once, together with the first box it overlaps.
+    unique_boxes, pair_indices = np.unique(boxes[selected], return_index=True)
+    return np.stack([unique_boxes, others[selected][pair_indices]], axis=1).reshape(-1, 2)
+
+
+def _box_location(analysis, box):
+    crop_index, type_index = divmod(int(analysis['segments'][box]), len(CHECKED_BOXES_TYPES))
+    return analysis['crop_paths'][crop_index], CHECKED_BOXES_TYPES[type_index]
+
+
+def remove_overlapping_boxes(
+        boxes: list,
+        reference_boxes: list,
+        iou_threshold: float,
+):
+    if not boxes or not reference_boxes:
+        return list(boxes)
+    candidates = np.array([box[0] for box in boxes])
+    references = np.array([box[0] for box in reference_boxes])
+    iou = pairwise_iou(
+        np.repeat(candidates, len(references), axis=0),
+        np.tile(references, (len(candidates), 1)),
+    )
+    overlapping = (iou.reshape(len(candidates), len(references)) > iou_threshold).any(axis=1)
+    return [box for box, overlaps in zip(boxes, overlapping) if not overlaps]
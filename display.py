@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+import numpy as np
+
+DISPLAY_LOW_PERCENTILE = 0.5
+DISPLAY_HIGH_PERCENTILE = 99.5
+DISPLAY_SAMPLE_STEP = 8
+DISPLAY_CACHE_SIZE = 16
+
+
+def compute_display_limits(
+        crops: list,
+        sample_step: int = DISPLAY_SAMPLE_STEP,
+):
+    samples = [crop[::sample_step, ::sample_step].ravel() for crop in crops]
+    # Tiles outside of the scanned area are constant and would drag the limits towards their fill value.
+    samples = [sample for sample in samples if sample.min() != sample.max()] or samples
+    low, high = np.percentile(np.concatenate(samples), [DISPLAY_LOW_PERCENTILE, DISPLAY_HIGH_PERCENTILE])
+    return float(low), float(max(high, low + 1))
+
+
+def build_display_lut(
+        low: float,
+        high: float,
+        dtype: np.dtype,
+):
+    values = np.arange(np.iinfo(dtype).max + 1, dtype=np.float32)
+    return (np.clip((values - low) / (high - low), 0, 1) * 255).astype(np.uint8)
+
+
+class DisplayCrops:
+    def __init__(self, crops, limits: tuple = None):
+        self.crops = crops
+        self.cache = OrderedDict()
+        self.lut = None
+        self.limits = limits
+        if len(crops) > 0:
+            if self.limits is None:
+                self.limits = compute_display_limits(crops)
+            # Remote crops know their dtype, reading it from the first crop would download that tile.
+            dtype = getattr(crops, 'dtype', None) or crops[0].dtype
+            if np.issubdtype(dtype, np.unsignedinteger) and dtype.itemsize <= 2:
+                self.lut = build_display_lut(*self.limits, dtype)
+
+    def __len__(self):
+        return len(self.crops)
+
+    def __getitem__(self, index: int):
+        index = index % len(self.crops)
+        if index in self.cache:
+            self.cache.move_to_end(index)
+        else:
+            self.cache[index] = self._convert(self.crops[index])
+            while len(self.cache) > DISPLAY_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return self.cache[index]
+
+    def _convert(self, crop):
+        if self.lut is not None:
+            return self.lut[crop]
+        low, high = self.limits
+        return (np.clip((crop - low) / (high - low), 0, 1) * 255).astype(np.uint8)
@@ -4,11 +4,11 @@ import sys
 from enum import Enum
 from pathlib import Path
 
-import cv2
-import pandas as pd
+import numpy as np
 
 IMAGE_WIDTH = 1280
 IMAGE_HEIGHT = 960
+VERTICAL_LABEL_END = 23
 
 
 class ImageTypeString(Enum):
@@ -31,56 +31,102 @@ def process_probe_directories(
             sys.exit()
 
 
+def crop_probe_directory(
+        processing_directory: str,
+        probe_directory: str,
+):
+    tif_path_string = f'{processing_directory}/{probe_directory}/images/{probe_directory}_map.tif'
+    try:
+        tif_path = Path(glob.glob(tif_path_string)[0])
+
+        fast_syns = glob.glob(f'{processing_directory}/{probe_directory}/images/*FAST.SYN._FP.png')
+        firsts = [str(Path(s).name)[12:14] for s in fast_syns]
+        first_end = int(max(firsts))
+
+        return crop_tif_map(tif_path, first_end)
+    except IndexError:
+        return [], [], []
+
+
 def crop_tif_map(
         tif_path: Path,
         label_end: int,
 ):
+    # OpenCV and pandas are imported on first use, which keeps them off the annotation tool's startup path.
+    import cv2
+
     tif_map = cv2.imread(str(tif_path), cv2.IMREAD_UNCHANGED)
+    tiles = tile_tif_map(tif_map)
+    probe_directory = tif_path.parents[1]
+    tile_table = build_tile_table(probe_directory.name, label_end, *tiles.shape[:2])
+    crops = [tile for vertical_tiles in tiles for tile in vertical_tiles]
+    crop_names = tile_table['crop_name'].tolist()
+    existing_bounding_boxes = _get_tiles_bounding_boxes(probe_directory, tile_table['image_name'].tolist())
+    return crops, crop_names, existing_bounding_boxes
 
-    vertical_tiles = tif_map.shape[0] // IMAGE_HEIGHT
-    vertical_tif_labels = range(23, 23 - vertical_tiles, -1)
+
+def tile_tif_map(
+        tif_map: np.ndarray,
+):
     horizontal_tiles = tif_map.shape[1] // IMAGE_WIDTH
-    horizontal_tif_labels = range(label_end, label_end - horizontal_tiles, -1)
-    crops = []
-    crop_names = []
-    existing_bounding_boxes = []
-    for i, label_i in zip(range(horizontal_tiles), horizontal_tif_labels):
-        for j, label_j in zip(range(vertical_tiles), vertical_tif_labels):
-            probe_directory = tif_path.parents[1]
-            crop = tif_map[j * IMAGE_HEIGHT:(j + 1) * IMAGE_HEIGHT, i * IMAGE_WIDTH:(i + 1) * IMAGE_WIDTH]
-            crops.append(crop)
-            crop_name = _build_crop_name(probe_directory.name, label_i, label_j, ImageTypeString.RAW)
-            crop_names.append(crop_name)
-            bounding_boxes = _get_image_bounding_boxes(
-                probe_directory,
-                _build_crop_name(probe_directory.name, label_i, label_j, ImageTypeString.TIF)
-            )
-            existing_bounding_boxes.append(bounding_boxes)
-    crops.reverse()
-    crop_names.reverse()
-    existing_bounding_boxes.reverse()
-    return crops, crop_names, existing_bounding_boxes
+    vertical_tiles = tif_map.shape[0] // IMAGE_HEIGHT
+    row_stride, column_stride = tif_map.strides[:2]
+    tiles = np.lib.stride_tricks.as_strided(
+        tif_map,
+        shape=(horizontal_tiles, vertical_tiles, IMAGE_HEIGHT, IMAGE_WIDTH) + tif_map.shape[2:],
+        strides=(IMAGE_WIDTH * column_stride, IMAGE_HEIGHT * row_stride) + tif_map.strides,
+        writeable=False,
+    )
+    # Crops are ordered from the last horizontal and vertical tile backwards, tiles[a, b] is crop a * vertical_tiles + b.
+    return tiles[::-1, ::-1]
+
+
+def build_tile_table(
+        directory_name: str,
+        label_end: int,
+        horizontal_tiles: int,
+        vertical_tiles: int,
+        pmon_string: str = 'pmon-00013',
+):
+    import pandas as pd
+
+    tile_index = np.arange(horizontal_tiles * vertical_tiles)
+    horizontal_index = horizontal_tiles - 1 - tile_index // vertical_tiles
+    vertical_index = vertical_tiles - 1 - tile_index % vertical_tiles
+    horizontal_label = label_end - horizontal_index
+    vertical_label = VERTICAL_LABEL_END - vertical_index
+
+    directory_date, directory_probe = directory_name.split('_')
+    name_stem = 'polle-im_01_' + pd.Series(horizontal_label).astype(str).str.zfill(2) + '_' \
+        + pd.Series(vertical_label).astype(str).str.zfill(2) + f'-{directory_date}-{pmon_string}-{directory_probe}-tiff'
+    return pd.DataFrame({
+        'tile_index': tile_index,
+        'horizontal_index': horizontal_index,
+        'vertical_index': vertical_index,
+        'horizontal_label': horizontal_label,
+        'vertical_label': vertical_label,
+        'crop_name': name_stem + ImageTypeString.RAW.value,
+        'image_name': name_stem + ImageTypeString.TIF.value,
+    })
 
 
-def _get_image_bounding_boxes(probe_directory, image_name):
+def _get_tiles_bounding_boxes(probe_directory, image_names):
+    if not image_names:
+        return []
+    import pandas as pd
+
     label_info = pd.read_csv(probe_directory / 'csv' / f'{probe_directory.name}_01_class.csv', sep=';')
-    label_info = label_info.loc[label_info['ImageName'] == image_name][['x', 'y', 'Width', 'Height', 'PollenSpecies', 'PredictedPollenSpecies', 'PredictedPollenSpeciesLatin']]
+    label_info = label_info.loc[label_info['ImageName'].isin(image_names)][['ImageName', 'x', 'y', 'Width', 'Height', 'PollenSpecies', 'PredictedPollenSpecies', 'PredictedPollenSpeciesLatin']]
     label_info['x2'] = label_info['x'] + label_info['Width']
     label_info['y2'] = label_info['y'] + label_info['Height']
-    label_info['bounding_boxes'] = list(label_info[['x', 'y', 'x2', 'y2']].to_numpy())
     label_info['label'] = label_info['PollenSpecies']
     label_info['label'] = label_info['label'].where(label_info['PollenSpecies'] != '--', label_info['PredictedPollenSpecies'])
     label_info['label'] = label_info['label'].where(label_info['PollenSpecies'] != 'Y', label_info['PredictedPollenSpeciesLatin'])
-    return [[row[0].tolist(), row[1]] for row in label_info[['bounding_boxes', 'label']].to_numpy()]
-
-
-def _build_crop_name(
-        directory_name: str,
-        horizontal_label,
-        vertical_label,
-        image_type_string: ImageTypeString,
-        pmon_string: str = 'pmon-00013',
-):
-    directory_date, directory_probe = directory_name.split('_')
-    return f'polle-im_01_{str(horizontal_label).zfill(2)}_{str(vertical_label).zfill(2)}-{directory_date}-' \
-           f'{pmon_string}-{directory_probe}-tiff{image_type_string.value}'
+    bounding_boxes = {image_name: [] for image_name in image_names}
+    for image_name, bounding_box, label in zip(
+            label_info['ImageName'],
+            label_info[['x', 'y', 'x2', 'y2']].to_numpy().tolist(),
+            label_info['label'],
+    ):
+        bounding_boxes[image_name].append([bounding_box, label])
+    return [bounding_boxes[image_name] for image_name in image_names]
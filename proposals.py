@@ -0,0 +1,65 @@
+import concurrent.futures
+import multiprocessing
+import os
+
+import numpy as np
+
+PROPOSAL_LABEL = 'Proposal'
+PROPOSAL_IOU_THRESHOLD = 0.3
+MIN_PROPOSAL_AREA = 400
+MAX_PROPOSAL_AREA = 40000
+
+
+def detect_blobs(crop: np.ndarray):
+    # Only the worker processes need OpenCV.
+    import cv2
+
+    gray = crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+    # Grains are darker than the background, so the inverted Otsu mask marks them as foreground.
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((5, 5), np.uint8))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    proposed_boxes = []
+    for contour in contours:
+        x, y, width, height = cv2.boundingRect(contour)
+        if MIN_PROPOSAL_AREA <= width * height <= MAX_PROPOSAL_AREA:
+            proposed_boxes.append([[x, y, x + width, y + height], PROPOSAL_LABEL])
+    return proposed_boxes
+
+
+class ProposalGenerator:
+    def __init__(self, detector=detect_blobs, max_workers=None):
+        self.detector = detector
+        # Forking the window's process would copy the state of its Qt and pool threads, so workers are spawned.
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers or max(1, (os.cpu_count() or 2) - 1),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        self.cache = {}
+        self.pending = {}
+
+    def submit(self, crop_path: str, crop: np.ndarray):
+        if crop_path in self.cache or crop_path in self.pending:
+            return
+        self.pending[crop_path] = self.executor.submit(self.detector, crop)
+
+    def get(self, crop_path: str):
+        future = self.pending.get(crop_path)
+        if future is not None and future.done():
+            del self.pending[crop_path]
+            try:
+                self.cache[crop_path] = future.result()
+            except Exception as error:
+                print(f'Proposal generation failed for {crop_path}: {error}')
+                self.cache[crop_path] = []
+        return self.cache.get(crop_path)
+
+    def discard_pending(self, keep):
+        for crop_path in list(self.pending.keys()):
+            if crop_path not in keep and self.pending[crop_path].cancel():
+                del self.pending[crop_path]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)